@@ -46,11 +46,14 @@ def train(num_epochs, config, data_loader, multigpu=False):
     
     def maybe_report_time():
         if False and epoch % 100 == 0 and epoch > 0:
-            finish_time = time.clock()
+            if torch.cuda.is_available():
+                # wait for queued kernels, or this only measures launch time
+                torch.cuda.synchronize()
+            finish_time = time.perf_counter()
             time_per_epoch = (finish_time - start_time) / epoch
             print('Average time per epoch: {:.2} sec'.format(time_per_epoch))
 
-    start_time = time.clock()
+    start_time = time.perf_counter()
     print('hi')
     net_factory = config.create_network_factory()
     model = net_factory(data_loader.input_size(), data_loader.output_size())
@@ -1,6 +1,9 @@
     
 import nltk
 import random
+from bisect import bisect_left, bisect_right
+from collections import Counter, deque
+from functools import lru_cache
 nltk.download('wordnet')
 
 from nltk.corpus import wordnet as wn
@@ -25,10 +28,12 @@ def hypernym_chain(synset_name):
 
 def get_all_hypernyms_from_sense(sense):
     result = set()
-    for y in sense.hypernyms():
-        result.add(y)
-        for z in get_all_hypernyms_from_sense(y):
-            result.add(z)
+    worklist = deque([sense])
+    while worklist:
+        for y in worklist.popleft().hypernyms():
+            if y not in result:
+                result.add(y)
+                worklist.append(y)
     return result
 
 def get_all_hypernyms(word):
@@ -57,17 +62,17 @@ def get_all_hyponyms_from_sense(sense):
     
     """
     result = set()
-    for y in sense.hyponyms():
-        result.add(y)
-        for z in get_all_hyponyms_from_sense(y):
-            result.add(z)
+    worklist = deque([sense])
+    while worklist:
+        for y in worklist.popleft().hyponyms():
+            if y not in result:
+                result.add(y)
+                worklist.append(y)
     return result
 
+@lru_cache(maxsize=None)
 def normalize_lemma(lemma):
-    lemma = " ".join(lemma.split("_"))
-    lemma = " ".join(lemma.split("-"))
-    lemma = lemma.lower()
-    return lemma
+    return lemma.replace("_", " ").replace("-", " ").lower()
 
 def get_all_lemmas_from_sense(sense):
     result = set()
@@ -112,14 +117,19 @@ def find_lowest_common_ancestor(words):
 class GetRandomSynset:
     def __init__(self, root_synset):
         entity = wn.synset(root_synset)
-        self.entity_hyps = get_all_hyponyms_from_sense(entity)
-        specificity = Specificity()
+        self.entity_hyps_set = get_all_hyponyms_from_sense(entity)
+        self.entity_hyps = tuple(self.entity_hyps_set)
         self.specificities = {hyponym: specificity.evaluate(hyponym) for 
                               hyponym in self.entity_hyps}
+        # hyponyms sorted by specificity, so a specificity band is a slice
+        by_specificity = sorted(self.specificities.items(), key=lambda kv: kv[1])
+        self.sorted_specificities = [spec for (_, spec) in by_specificity]
+        self.sorted_hyps = tuple(hyp for (hyp, _) in by_specificity)
+        self.candidates = dict()
         
 
     def __call__(self):
-        random_word = random.sample(self.entity_hyps,1)[0]
+        random_word = random.choice(self.entity_hyps)
         return random_word
     
     @staticmethod    
@@ -128,9 +138,11 @@ class GetRandomSynset:
     
 
     def random_synset_with_specificity(self, lower, upper):
-        candidates = [hyp for hyp in self.specificities if 
-                      self.specificities[hyp] >= lower and
-                      self.specificities[hyp] <= upper]
+        if (lower, upper) not in self.candidates:
+            start = bisect_left(self.sorted_specificities, lower)
+            stop = bisect_right(self.sorted_specificities, upper)
+            self.candidates[(lower, upper)] = self.sorted_hyps[start:stop]
+        candidates = self.candidates[(lower, upper)]
         if len(candidates) > 0:
             return random.choice(candidates)
         else:
@@ -139,7 +151,7 @@ class GetRandomSynset:
     def random_non_hyponym(self, synset_name):
         synset = wn.synset(synset_name)
         hyponyms = get_all_hyponyms_from_sense(synset) | set([synset])
-        other_synsets = list(self.entity_hyps - hyponyms)
+        other_synsets = list(self.entity_hyps_set - hyponyms)
         assert(len(other_synsets) > 0)
         return random.choice(other_synsets)
 
@@ -201,12 +213,16 @@ class Repitition:
         self.entity_hypos = self.generate_entity_hypos()
     
     def generate_entity_hypos(self):
+        """
+        Maps each synset to the number of times it appears in
+        get_all_hyponyms_from_sense_to_list(entity).
+        
+        """
         entity = wn.synset("entity.n.1")
-        res = [hyp for hyp in get_all_hyponyms_from_sense_to_list(entity)]
-        return res
+        return Counter(get_all_hyponyms_from_sense_to_list(entity))
     
     def num_repititions_from_sense(self, sense):
-        return self.entity_hypos.count(sense)
+        return self.entity_hypos[sense]
     
 # if __name__ == "__main__":
 #     generate_synset = GetRandomSynset('dog.n.1')
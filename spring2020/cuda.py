@@ -2,7 +2,8 @@ import torch
 
 if torch.cuda.is_available():
     print("using gpu")
-    cuda = torch.device('cuda:0')
+    # the current GPU, so each torchrun process uses the one it selected
+    cuda = torch.device('cuda')
     FloatTensor = torch.cuda.FloatTensor
     LongTensor = torch.cuda.LongTensor
     def cudaify(model):
@@ -1,21 +1,125 @@
+import contextlib
+import os
 import torch
+import torch.distributed as dist
 import torch.nn as nn
-from torch.utils.data import Dataset, DataLoader
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import Dataset
 import torch.optim as optim
 import torch.nn.functional as F
-from puzzle import make_puzzle_matrix, make_puzzle_targets, WordnetPuzzleGenerator
+from puzzle import make_puzzle_indices, make_puzzle_targets
+from puzzle import WordnetPuzzleGenerator, ParallelPuzzleGenerator
+from puzzle import distinct_puzzles
+import math
+from functools import lru_cache
+import threading
 import time
 from wordnet import hypernym_chain
 
 
-device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+# "cuda" rather than "cuda:0": under torchrun each process selects its own
+# GPU with torch.cuda.set_device, and "cuda" follows that choice.
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+# Mixed precision on the GPU: bfloat16 where supported, otherwise float16
+# (which needs loss scaling). On the CPU everything stays in float32.
+use_amp = device.type == 'cuda'
+
+@lru_cache(maxsize=None)
+def amp_dtype():
+    # Asked lazily: querying the GPU initializes CUDA, which must not happen
+    # before train() has forked its puzzle workers. Only Ampere (compute
+    # capability 8) and later do bfloat16 natively; is_bf16_supported() also
+    # counts emulation, which would leave V100s and T4s without loss scaling.
+    if use_amp and torch.cuda.get_device_capability()[0] >= 8:
+        return torch.bfloat16
+    else:
+        return torch.float16
+
+def autocast():
+    return torch.autocast(device_type=device.type, dtype=amp_dtype(), 
+                          enabled=use_amp)
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+def unwrap_model(model):
+    """Returns the network under the torch.compile and DDP wrappers."""
+    model = getattr(model, '_orig_mod', model)
+    if isinstance(model, (DistributedDataParallel, nn.DataParallel)):
+        model = model.module
+    return model
+
+class BackgroundSaver:
+    """Writes model checkpoints from a background thread."""
+    
+    def __init__(self):
+        self.thread = None
+        
+    def save(self, model, path):
+        # Snapshot the parameters on the CPU first, so the thread doesn't
+        # race with the optimizer updating them.
+        state_dict = {k: v.detach().to('cpu', copy=True) 
+                      for (k, v) in unwrap_model(model).state_dict().items()}
+        self.wait()
+        self.thread = threading.Thread(target=torch.save, 
+                                       args=(state_dict, path))
+        self.thread.start()
+        
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+class PuzzleBatchLoader:
+    """Batches a PuzzleDataset by indexing its device tensors directly."""
+    
+    def __init__(self, dataset, batch_size, shuffle):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.epoch = 0
+        if is_distributed():
+            self.rank = dist.get_rank()
+            self.world_size = dist.get_world_size()
+        else:
+            self.rank = 0
+            self.world_size = 1
+        
+    def set_epoch(self, epoch):
+        # seeds the shuffle, so that all processes agree on it
+        self.epoch = epoch
+        
+    def _num_rows(self):
+        # drops the few leftover rows so every process gets the same count
+        return len(self.dataset) // self.world_size
+        
+    def __iter__(self):
+        num_rows = len(self.dataset)
+        if self.shuffle and self.world_size > 1:
+            generator = torch.Generator()
+            generator.manual_seed(self.epoch)
+            order = torch.randperm(num_rows, generator=generator).to(device)
+        elif self.shuffle:
+            order = torch.randperm(num_rows, device=device)
+        else:
+            order = torch.arange(num_rows, device=device)
+        order = order[self.rank::self.world_size][:self._num_rows()]
+        for batch_indices in order.split(self.batch_size):
+            yield self.dataset[batch_indices]
+    
+    def __len__(self):
+        return (self._num_rows() + self.batch_size - 1) // self.batch_size
+
 
 class PuzzleDataset(Dataset):
 
     def __init__(self, puzzles, vocab):
         self.vocab = vocab
-        self.evidence_matrix = make_puzzle_matrix(puzzles, vocab)
-        self.response_vector = make_puzzle_targets([label for (_, label) in puzzles])
+        self.evidence_indices = make_puzzle_indices(puzzles, vocab).to(device)
+        self.response_vector = make_puzzle_targets([label for (_, label) in puzzles]).to(device)
         self.num_choices = 5
 
 
@@ -23,44 +127,62 @@ class PuzzleDataset(Dataset):
         return len(self.vocab) * self.num_choices
 
     def __getitem__(self, index):
-        return self.evidence_matrix[index], self.response_vector[index]
+        return self.evidence_indices[index], self.response_vector[index]
 
     def __len__(self):
-        return len(self.evidence_matrix)   
+        return len(self.evidence_indices)   
 
     @staticmethod
     def generate(generator, num_train):
-        data = list(set(generator.batch_generate(num_train)))
+        if is_distributed():
+            # every process must train on the same puzzles, so rank 0
+            # generates them and shares them with the others
+            data = [None]
+            if dist.get_rank() == 0:
+                data[0] = distinct_puzzles(generator.batch_generate(num_train))
+            dist.broadcast_object_list(data, src=0)
+            data = data[0]
+        else:
+            data = distinct_puzzles(generator.batch_generate(num_train))
         return PuzzleDataset(data, generator.get_vocab())
 
     @staticmethod
     def compile_puzzle(generator, puzzle):
-        return make_puzzle_matrix([(puzzle, -1)], generator.get_vocab())
+        return make_puzzle_indices([(puzzle, -1)], generator.get_vocab())
    
     @staticmethod
-    def create_data_loader(dataset, batch_size):
-        dataloader = DataLoader(dataset = dataset, 
-                                     batch_size = batch_size, 
-                                     shuffle=True)
-        return dataloader
+    def create_data_loader(dataset, batch_size, shuffle=True):
+        return PuzzleBatchLoader(dataset, batch_size, shuffle)
 
 
 class PhraseEncoder(nn.Module):
+    """
+    Encodes phrases given as rows of vocab indices. The first layer sums the
+    embeddings of the phrase's words, which is what a linear layer applied to
+    the phrase's bag-of-words vector would compute, without ever building
+    that vector.
+    
+    """
     def __init__(self, vocab_size, hidden_size):
         super(PhraseEncoder, self).__init__()
         self.hidden_size = hidden_size
-        self.linear1 = nn.Linear(vocab_size, hidden_size)
+        self.embedding1 = nn.EmbeddingBag(vocab_size, hidden_size, mode='sum')
+        self.bias1 = nn.Parameter(torch.empty(hidden_size))
+        # same initialization as nn.Linear(vocab_size, hidden_size)
+        bound = 1 / math.sqrt(vocab_size)
+        nn.init.uniform_(self.embedding1.weight, -bound, bound)
+        nn.init.uniform_(self.bias1, -bound, bound)
         self.dropout = torch.nn.Dropout(p=0.2)
         self.linear2 = nn.Linear(hidden_size, hidden_size)
         self.linear3 = nn.Linear(hidden_size, hidden_size)
         self.linear4 = nn.Linear(hidden_size, hidden_size)
  
-    def forward(self, input_vec):
-        output = self.linear1(input_vec).clamp(min=0)
+    def forward(self, word_ids):
+        output = F.relu(self.embedding1(word_ids) + self.bias1)
         output = self.dropout(output)
-        output = self.linear2(output).clamp(min=0)
+        output = F.relu(self.linear2(output))
         output = self.dropout(output)
-        output = self.linear3(output).clamp(min=0)
+        output = F.relu(self.linear3(output))
         output = self.linear4(output)
         return output
         
@@ -80,22 +202,20 @@ class TiedClassifier(nn.Module):
         self.linear5 = nn.Linear(hidden_size, hidden_size)
         self.final_layer = nn.Linear(hidden_size, num_labels)
 
-    def forward(self, input_vec):
-        t = input_vec
-        output1 = self.word_encoder(t[:,0*self.vocab_size:1*self.vocab_size])
-        output2 = self.word_encoder(t[:,1*self.vocab_size:2*self.vocab_size])
-        output3 = self.word_encoder(t[:,2*self.vocab_size:3*self.vocab_size])
-        output4 = self.word_encoder(t[:,3*self.vocab_size:4*self.vocab_size])
-        output5 = self.word_encoder(t[:,4*self.vocab_size:5*self.vocab_size])
-        nextout = torch.cat([output1, output2, output3, output4, output5], dim=1) 
-        nextout = self.linear3(nextout).clamp(min=0)
+    def forward(self, word_ids):
+        # Encode all five choices in one call by folding them into the batch;
+        # each choice is a one-word phrase.
+        t = word_ids.reshape(-1, 1)
+        nextout = self.word_encoder(t).view(-1, 5*self.hidden_size)
+        nextout = F.relu(self.linear3(nextout))
         nextout = self.dropout(nextout)
-        nextout = self.linear4(nextout).clamp(min=0)
+        nextout = F.relu(self.linear4(nextout))
         nextout = self.dropout(nextout)
-        nextout = self.linear5(nextout).clamp(min=0)
+        nextout = F.relu(self.linear5(nextout))
         nextout = self.dropout(nextout)
         nextout = self.final_layer(nextout)
-        return F.log_softmax(nextout, dim=1)
+        # raw logits: the log-softmax is fused into the cross-entropy loss
+        return nextout
      
 
 def evaluate(model, loader):
@@ -104,14 +224,17 @@ def evaluate(model, loader):
     with torch.no_grad():
         correct = 0
         total = 0
-        for data, response in loader:
-            input_matrix = data.to(device)
-            log_probs = model(input_matrix)
-            predictions = log_probs.argmax(dim=1)
+        for input_matrix, response in loader:
+            with autocast():
+                logits = model(input_matrix)
+            predictions = logits.argmax(dim=1)
             total += predictions.shape[0]
-            for i in range(predictions.shape[0]):
-                if response[i].item() == predictions[i].item():
-                    correct += 1
+            correct += (predictions == response).sum().item()
+    if is_distributed():
+        # each process only saw its share of the test rows
+        counts = torch.tensor([correct, total], device=device)
+        dist.all_reduce(counts)
+        correct, total = counts.tolist()
     return correct / total
 
 def predict(model, puzzle, generator):
@@ -119,18 +242,21 @@ def predict(model, puzzle, generator):
     model.eval()
     input_matrix = compiled.to(device)
     model = model.to(device)
-    log_probs = model(input_matrix)
-    predictions = log_probs.argmax(dim=1)
+    logits = model(input_matrix)
+    predictions = logits.argmax(dim=1)
     return predictions    
 
 def train(final_root_synset, initial_root_synset, num_epochs, hidden_size, 
-          num_puzzles_to_generate, batch_size, multigpu = False):
+          num_puzzles_to_generate, batch_size, multigpu = False,
+          gradient_accumulation_steps = 1, num_puzzle_workers = 4):
+    """Trains the classifier, on all GPUs when multigpu=True (under torchrun)."""
     def maybe_regenerate(puzzle_generator, epoch, prev_loader, prev_test_loader):
         if epoch % 100 == 0:
             dataset = PuzzleDataset.generate(puzzle_generator, num_puzzles_to_generate)
-            loader = DataLoader(dataset = dataset, batch_size = batch_size, shuffle=True)
+            loader = PuzzleDataset.create_data_loader(dataset, batch_size)
             test_dataset = PuzzleDataset.generate(puzzle_generator, 100)
-            test_loader = DataLoader(dataset = test_dataset, batch_size = 100, shuffle=False)
+            test_loader = PuzzleDataset.create_data_loader(test_dataset, 100, 
+                                                           shuffle=False)
             return loader, test_loader
         else:
             return prev_loader, prev_test_loader
@@ -140,73 +266,127 @@ def train(final_root_synset, initial_root_synset, num_epochs, hidden_size,
         best_test_acc = prev_best_acc
         if epoch % 100 == 99:
             test_acc = evaluate(model, test_loader)
-            print('epoch {} test ({}): {:.2f}'.format(epoch, current_root, test_acc))
+            if is_main_process:
+                print('epoch {} test ({}): {:.2f}'.format(epoch, current_root, test_acc))
             if test_acc > prev_best_acc:
                 best_test_acc = test_acc
                 best_model = model
-                print('saving new model')
-                torch.save(best_model.state_dict, 'best.model')
+                if is_main_process:
+                    print('saving new model')
+                    saver.save(best_model, 'best.model')
         return best_model, best_test_acc
     
     def maybe_report_time():
-        if False and epoch % 100 == 0 and epoch > 0:
-            finish_time = time.clock()
+        if False and is_main_process and epoch % 100 == 0 and epoch > 0:
+            if device.type == 'cuda':
+                # wait for queued kernels, or this only measures launch time
+                torch.cuda.synchronize()
+            finish_time = time.perf_counter()
             time_per_epoch = (finish_time - start_time) / epoch
             print('Average time per epoch: {:.2} sec'.format(time_per_epoch))
 
 
-    start_time = time.clock()
+    start_time = time.perf_counter()
     puzzle_generator = WordnetPuzzleGenerator(final_root_synset)
-    input_size = 5 * len(puzzle_generator.get_vocab())
-    output_size = 5
-    model = TiedClassifier(input_size, output_size, hidden_size)
-    if multigpu and torch.cuda.device_count() > 1:
-        print("Let's use", torch.cuda.device_count(), "GPUs!")
-        #dim = 0 [30, xxx] -> [10, ...], [10, ...], [10, ...] on 3 GPUs
-        model = nn.DataParallel(model)
-    
-    model.to(device)
-    loader = None
-    test_loader = None
-    loss_function = nn.NLLLoss()
-    optimizer = optim.Adam(model.parameters())
-    best_model = None
-    best_test_acc = -1.0
-    puzzle_generator.reset_root(initial_root_synset)
-    for epoch in range(num_epochs):
-        model.train()
-        model.zero_grad()
-        loader, test_loader = maybe_regenerate(puzzle_generator, epoch, 
-                                               loader, test_loader)
-        for data, response in loader:
-            input_matrix = data.to(device)
-            log_probs = model(input_matrix)
-            loss = loss_function(log_probs, response)
-            loss.backward()
-            optimizer.step()
-        best_model, best_test_acc = maybe_evaluate(model, epoch, initial_root_synset,
-                                                   best_model, best_test_acc)
-        
-        if best_test_acc > .8 and initial_root_synset != final_root_synset:
-            current_root = initial_root_synset
-            initial_root_synset = hypernym_chain(initial_root_synset)[1].name()
-            puzzle_generator.reset_root(initial_root_synset)
-            print("Successful training of {}! Moving on to {}.".format(current_root, initial_root_synset))
-            print('saving new model')
-            torch.save(model.state_dict(), 'best.model')
-            best_test_acc = -1.0
-            loader, test_loader = maybe_regenerate(puzzle_generator, 100, 
+    if int(os.environ.get('RANK', 0)) == 0:
+        # Only rank 0 generates puzzles. Its workers are forked here, before
+        # NCCL, the CUDA context or the checkpoint thread exist; the workers
+        # themselves never use CUDA.
+        puzzle_generator = ParallelPuzzleGenerator(puzzle_generator, 
+                                                   num_puzzle_workers)
+    try:
+        if multigpu:
+            if 'LOCAL_RANK' not in os.environ:
+                raise Exception('multigpu training must be launched with torchrun.')
+            dist.init_process_group('nccl')
+            local_rank = int(os.environ['LOCAL_RANK'])
+            torch.cuda.set_device(local_rank)
+        is_main_process = not is_distributed() or dist.get_rank() == 0
+        if is_distributed() and is_main_process:
+            print("Let's use", dist.get_world_size(), "GPUs!")
+        input_size = 5 * len(puzzle_generator.get_vocab())
+        output_size = 5
+        model = TiedClassifier(input_size, output_size, hidden_size)
+        model.to(device)
+        if is_distributed():
+            model = DistributedDataParallel(model, device_ids=[local_rank])
+        if device.type == 'cuda':
+            # Lets Inductor fuse the relu/dropout chains into the linear layers.
+            # Compiling outside DDP lets the compiler split the graph at DDP's
+            # bucket boundaries, so the all-reduces still overlap the backward.
+            # No CUDA graphs: batch shapes vary (ragged last batch, and dataset
+            # sizes change with each regeneration), and each new shape would
+            # record another graph.
+            model = torch.compile(model, mode='max-autotune-no-cudagraphs', 
+                                  fullgraph=True)
+        loader = None
+        test_loader = None
+        loss_function = nn.CrossEntropyLoss()
+        optimizer = optim.Adam(model.parameters())
+        scaler = torch.amp.GradScaler(device.type, enabled = use_amp and 
+                                      amp_dtype() == torch.float16)
+        best_model = None
+        best_test_acc = -1.0
+        saver = BackgroundSaver()
+        puzzle_generator.reset_root(initial_root_synset)
+        for epoch in range(num_epochs):
+            model.train()
+            loader, test_loader = maybe_regenerate(puzzle_generator, epoch, 
                                                    loader, test_loader)
+            loader.set_epoch(epoch)
+            num_batches = len(loader)
+            for i, (input_matrix, response) in enumerate(loader):
+                is_step = ((i + 1) % gradient_accumulation_steps == 0 or 
+                           i + 1 == num_batches)
+                # the last group of an epoch may be short
+                group_start = i - i % gradient_accumulation_steps
+                group_size = min(gradient_accumulation_steps, 
+                                 num_batches - group_start)
+                if is_distributed() and not is_step:
+                    # the forward pass must be inside no_sync too
+                    sync_context = model.no_sync()
+                else:
+                    sync_context = contextlib.nullcontext()
+                with sync_context:
+                    with autocast():
+                        logits = model(input_matrix)
+                        loss = loss_function(logits, response)
+                        loss = loss / group_size
+                    scaler.scale(loss).backward()
+                if is_step:
+                    scaler.step(optimizer)
+                    scaler.update()
+                    optimizer.zero_grad(set_to_none=True)
+            best_model, best_test_acc = maybe_evaluate(model, epoch, initial_root_synset,
+                                                       best_model, best_test_acc)
+        
+            if best_test_acc > .8 and initial_root_synset != final_root_synset:
+                current_root = initial_root_synset
+                initial_root_synset = hypernym_chain(initial_root_synset)[1].name()
+                puzzle_generator.reset_root(initial_root_synset)
+                if is_main_process:
+                    print("Successful training of {}! Moving on to {}.".format(current_root, initial_root_synset))
+                    print('saving new model')
+                    saver.save(model, 'best.model')
+                best_test_acc = -1.0
+                loader, test_loader = maybe_regenerate(puzzle_generator, 100, 
+                                                       loader, test_loader)
         
-        maybe_report_time()
-    return best_model
+            maybe_report_time()
+        saver.wait()
+        return best_model
+    finally:
+        if isinstance(puzzle_generator, ParallelPuzzleGenerator):
+            puzzle_generator.close()
+        if is_distributed():
+            dist.destroy_process_group()
 
 if __name__ == '__main__':
     train(final_root_synset = 'carnivore.n.01', 
           initial_root_synset = 'cat.n.01',
           num_epochs=300000, 
-          hidden_size=500,
+          hidden_size=512,
           num_puzzles_to_generate=2000,
           batch_size=256,
-          multigpu=False)
+          multigpu='LOCAL_RANK' in os.environ)
 
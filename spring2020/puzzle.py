@@ -1,4 +1,6 @@
+import multiprocessing
 import random
+from functools import lru_cache
 from wordnet import GetRandomSynset, get_all_hyponyms_from_sense
 from wordnet import get_all_lemmas_from_sense, normalize_lemma
 from nltk.corpus import wordnet as wn
@@ -22,28 +24,25 @@ class WordnetPuzzleGenerator(PuzzleGenerator):
     def __init__(self, root_synset):
         super(WordnetPuzzleGenerator, self).__init__()
         self.root_synset = wn.synset(root_synset)
-        self.synset_gen = GetRandomSynset(root_synset)
+        self.synset_gen = GetRandomSynset.factory(root_synset)
         self.vocab = self._build_vocab()
         
     def _build_vocab(self):
-        words = list(get_all_lemmas_from_sense(self.root_synset))
-        word_to_ix = dict([(v, k) for (k,v) in enumerate(words)])
-        print("vocab size: {}".format(len(word_to_ix)))
-        return word_to_ix
+        return _build_vocab_for_root(self.root_synset.name())
     
     def get_vocab(self):
         return self.vocab
     
     def reset_root(self, root_synset):
         self.root_synset = wn.synset(root_synset)
-        self.synset_gen = GetRandomSynset(root_synset)        
+        self.synset_gen = GetRandomSynset.factory(root_synset)
     
     def generate(self):
         root = self.synset_gen.random_synset_with_specificity(10, 1000)
         while root == self.root_synset:
             root = self.synset_gen.random_synset_with_specificity(10, 1000)
         hyps = get_all_lemmas_from_sense(root) # children?
-        puzzle = random.sample(hyps, 4)
+        puzzle = random.sample(tuple(hyps), 4)
         random_hyp = self.synset_gen.random_non_hyponym(root)
         random_word = random.choice(list(get_all_lemmas_from_sense(random_hyp)))
         puzzle.append(random_word)
@@ -55,6 +54,81 @@ class WordnetPuzzleGenerator(PuzzleGenerator):
         onehot = [j for (_,j) in result]
         return (xyz, onehot.index(1))
 
+class ParallelPuzzleGenerator(PuzzleGenerator):
+    """Spreads large batch_generate calls over forked worker processes."""
+    
+    def __init__(self, generator, num_workers = 4, 
+                 min_parallel_puzzles = 1000):
+        super(ParallelPuzzleGenerator, self).__init__()
+        self.generator = generator
+        self.num_workers = num_workers
+        self.min_parallel_puzzles = min_parallel_puzzles
+        context = multiprocessing.get_context('fork')
+        self.pool = context.Pool(num_workers, initializer = _init_worker, 
+                                 initargs = (generator,))
+        
+    def get_vocab(self):
+        return self.generator.get_vocab()
+    
+    def reset_root(self, root_synset):
+        # the workers follow along lazily; see _generate_shard
+        self.generator.reset_root(root_synset)
+        
+    def generate(self):
+        return self.generator.generate()
+    
+    def batch_generate(self, number_of_puzzles = 10):
+        if number_of_puzzles < self.min_parallel_puzzles:
+            return self.generator.batch_generate(number_of_puzzles)
+        root_synset_name = self.generator.root_synset.name()
+        shards = [(root_synset_name, 
+                   number_of_puzzles // self.num_workers + 
+                   (1 if i < number_of_puzzles % self.num_workers else 0))
+                  for i in range(self.num_workers)]
+        result = []
+        for shard in self.pool.map(_generate_shard, shards):
+            result.extend(shard)
+        return result
+    
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+def _init_worker(generator):
+    global _worker_generator
+    _worker_generator = generator
+    # reseed from os.urandom, so the workers don't all replay the state
+    # they inherited from the parent
+    random.seed()
+
+def _generate_shard(shard):
+    root_synset_name, number_of_puzzles = shard
+    if _worker_generator.root_synset.name() != root_synset_name:
+        _worker_generator.reset_root(root_synset_name)
+    return _worker_generator.batch_generate(number_of_puzzles)
+
+def distinct_puzzles(puzzles):
+    """
+    Removes repeated puzzles, keeping the first occurrence of each, in order.
+    
+    """
+    seen = set()
+    result = []
+    for puzzle in puzzles:
+        if puzzle not in seen:
+            seen.add(puzzle)
+            result.append(puzzle)
+    return result
+
+@lru_cache(maxsize=None)
+def _build_vocab_for_root(root_synset_name):
+    # sorted, so that the word indices don't depend on set iteration order
+    words = sorted(get_all_lemmas_from_sense(wn.synset(root_synset_name)))
+    word_to_ix = dict([(v, k) for (k,v) in enumerate(words)])
+    print("vocab size: {}".format(len(word_to_ix)))
+    return word_to_ix
+
 def one_hot(word, vocab):
     vec = [0]*len(vocab)
     vec[vocab[word]] = 1
@@ -77,6 +151,19 @@ def make_puzzle_matrix(puzzles, vocab):
         matrix.append(oneHotVec)
     return cudaify(FloatTensor(matrix))
 
+def make_puzzle_indices(puzzles, vocab):
+    """
+    Compact alternative to make_puzzle_matrix: row i holds the vocab index
+    of each choice of puzzle i, rather than their concatenated one-hot
+    vectors.
+    
+    """
+    matrix = []
+    for puzzle in puzzles:
+        choices, _ = puzzle
+        matrix.append([vocab[str(choice)] for choice in choices])
+    return cudaify(LongTensor(matrix))
+
 def make_puzzle_target(label):
     return cudaify(LongTensor([label]))
 
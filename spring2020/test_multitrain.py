@@ -0,0 +1,48 @@
+import os
+import tempfile
+import unittest
+import torch
+import torch.nn as nn
+from multitrain import unwrap_model, BackgroundSaver, PuzzleBatchLoader
+
+
+class TestMultitrain(unittest.TestCase):
+    
+    def test_unwrap_model(self):
+        network = nn.Linear(3, 2)
+        assert unwrap_model(network) is network
+        assert unwrap_model(nn.DataParallel(network)) is network
+    
+    def test_background_saver(self):
+        network = nn.Linear(3, 2)
+        saver = BackgroundSaver()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'best.model')
+            weight = network.weight.detach().clone()
+            saver.save(nn.DataParallel(network), path)
+            # the snapshot is taken before save returns
+            with torch.no_grad():
+                network.weight.add_(1.0)
+            saver.wait()
+            restored = nn.Linear(3, 2)
+            restored.load_state_dict(torch.load(path))
+            assert torch.equal(restored.weight, weight)
+            assert torch.equal(restored.bias, network.bias)
+            
+    def test_batch_loader_shards(self):
+        dataset = torch.arange(11)
+        shards = []
+        for rank in range(2):
+            loader = PuzzleBatchLoader(dataset, 2, shuffle=True)
+            loader.rank = rank
+            loader.world_size = 2
+            loader.set_epoch(3)
+            assert len(loader) == 3
+            shards.append(torch.cat(list(loader)).tolist())
+        assert len(shards[0]) == len(shards[1]) == 5
+        # the shards are disjoint, and together miss only the leftover row
+        assert len(set(shards[0]) | set(shards[1])) == 10
+        
+        
+if __name__ == "__main__":
+	unittest.main()
@@ -1,6 +1,8 @@
 import unittest
 from wordnet import find_lowest_common_ancestor, GetRandomSynset
 from puzzle import WordnetPuzzleGenerator
+from puzzle import make_puzzle_matrix, make_puzzle_indices
+from puzzle import PuzzleGenerator, ParallelPuzzleGenerator, distinct_puzzles
 from nltk.corpus import wordnet as wn
 
 
@@ -46,6 +48,66 @@ class TestPuzzle(unittest.TestCase):
         for puzzle in puzzles:
             print(puzzle)
     """
+
+class CountingPuzzleGenerator(PuzzleGenerator):
+    """Generates the puzzles ('0',)*5, ('1',)*5, ... labeled by the root."""
+    
+    class Root:
+        def __init__(self, name):
+            self._name = name
+        def name(self):
+            return self._name
+    
+    def __init__(self):
+        super(CountingPuzzleGenerator, self).__init__()
+        self.root_synset = CountingPuzzleGenerator.Root('a')
+        self.count = 0
+        
+    def reset_root(self, root_synset):
+        self.root_synset = CountingPuzzleGenerator.Root(root_synset)
+        
+    def generate(self):
+        self.count += 1
+        return ((str(self.count),) * 5, self.root_synset.name())
+    
+
+class TestPuzzleGeneration(unittest.TestCase):
+    
+    def test_distinct_puzzles(self):
+        puzzles = [(('b',) * 5, 0), (('a',) * 5, 1), (('b',) * 5, 0), 
+                   (('b',) * 5, 2), (('a',) * 5, 1), (('c',) * 5, 0)]
+        assert distinct_puzzles(puzzles) == [(('b',) * 5, 0), (('a',) * 5, 1), 
+                                             (('b',) * 5, 2), (('c',) * 5, 0)]
+        
+    def test_parallel_batch_generate(self):
+        generator = ParallelPuzzleGenerator(CountingPuzzleGenerator(), 
+                                            num_workers = 2,
+                                            min_parallel_puzzles = 10)
+        try:
+            # below the threshold, puzzles come from this process's generator
+            assert len(generator.batch_generate(5)) == 5
+            assert generator.generator.count == 5
+            # above it, the workers generate them with their own copies,
+            # which follow the reset root
+            generator.reset_root('b')
+            puzzles = generator.batch_generate(11)
+            assert generator.generator.count == 5
+            assert len(puzzles) == 11
+            assert all(label == 'b' for (_, label) in puzzles)
+        finally:
+            generator.close()
+
+
+class TestPuzzleEncoding(unittest.TestCase):
+    
+    def test_make_puzzle_indices(self):
+        vocab = {'cat': 0, 'dog': 1, 'emu': 2, 'owl': 3, 'yak': 4, 'ant': 5}
+        puzzles = [(('cat', 'dog', 'emu', 'owl', 'ant'), 4),
+                   (('yak', 'ant', 'cat', 'dog', 'owl'), 0)]
+        indices = make_puzzle_indices(puzzles, vocab)
+        assert indices.tolist() == [[0, 1, 2, 3, 5], [4, 5, 0, 1, 3]]
+        matrix = make_puzzle_matrix(puzzles, vocab)
+        assert matrix.view(2, 5, -1).argmax(dim=2).tolist() == indices.tolist()
        
 if __name__ == "__main__":
 	unittest.main()
@@ -1,6 +1,8 @@
 
 import nltk
 import random
+from bisect import bisect_left, bisect_right
+from functools import lru_cache
 nltk.download('wordnet')
 
 from nltk.corpus import wordnet as wn
@@ -24,12 +26,15 @@ def hypernym_chain(synset_name):
     return result
 
 def get_all_hypernyms_from_sense(sense):
+    return _all_hypernyms(sense.name())
+
+@lru_cache(maxsize=None)
+def _all_hypernyms(synset_name):
     result = set()
-    for y in sense.hypernyms():
+    for y in wn.synset(synset_name).hypernyms():
         result.add(y)
-        for z in get_all_hypernyms_from_sense(y):
-            result.add(z)
-    return result
+        result |= _all_hypernyms(y.name())
+    return frozenset(result)
 
 def get_all_hypernyms(word):
     """
@@ -47,30 +52,38 @@ def get_all_hyponyms_from_sense(sense):
     """
     e.g. get_all_hyponyms_from_sense(wn.synset('metallic_element.n.01'))
     
+    The result is cached by synset name and shared between callers, so it
+    is returned as a frozenset.
+    
     """
+    return _all_hyponyms(sense.name())
+
+@lru_cache(maxsize=None)
+def _all_hyponyms(synset_name):
     result = set()
-    for y in sense.hyponyms():
+    for y in wn.synset(synset_name).hyponyms():
         result.add(y)
-        for z in get_all_hyponyms_from_sense(y):
-            result.add(z)
-    return result
+        result |= _all_hyponyms(y.name())
+    return frozenset(result)
 
+@lru_cache(maxsize=None)
 def normalize_lemma(lemma):
-    lemma = " ".join(lemma.split("_"))
-    lemma = " ".join(lemma.split("-"))
-    lemma = lemma.lower()
-    return lemma
+    return lemma.replace("_", " ").replace("-", " ").lower()
     #return "_".join(lemma.split())
 
 
 def get_all_lemmas_from_sense(sense):
+    return _all_lemmas(sense.name())
+
+@lru_cache(maxsize=None)
+def _all_lemmas(synset_name):
+    sense = wn.synset(synset_name)
     result = set()
     for lemma in sense.lemmas():
         result.add(normalize_lemma(lemma.name()))
-    for y in get_all_hyponyms_from_sense(sense):
-        for lemma in y.lemmas():
-            result.add(normalize_lemma(lemma.name()))
-    return result
+    for y in sense.hyponyms():
+        result |= _all_lemmas(y.name())
+    return frozenset(result)
 
 
 
@@ -107,25 +120,37 @@ def find_lowest_common_ancestor(words):
 class GetRandomSynset:
     def __init__(self, root_synset = 'dog.n.1'):
         entity = wn.synset(root_synset)
-        self.entity_hyps = get_all_hyponyms_from_sense(entity)
-        specificity = Specificity()
+        self.entity_hyps = tuple(get_all_hyponyms_from_sense(entity))
         self.specificities = {hyponym: specificity.evaluate(hyponym) for 
                               hyponym in self.entity_hyps}
+        # hyponyms sorted by specificity, so a specificity band is a slice
+        by_specificity = sorted(self.specificities.items(), key=lambda kv: kv[1])
+        self.sorted_specificities = [spec for (_, spec) in by_specificity]
+        self.sorted_hyps = tuple(hyp for (hyp, _) in by_specificity)
+        self.candidates = dict()
         
 
     def __call__(self):
-        random_word = random.sample(self.entity_hyps,1)[0]
+        random_word = random.choice(self.entity_hyps)
         return random_word
     
-    @staticmethod    
+    @staticmethod
+    @lru_cache(maxsize=None)
     def factory(root_synset):
+        """
+        Returns a GetRandomSynset for the given root, reusing the one built
+        for an earlier request with the same root.
+        
+        """
         return GetRandomSynset(root_synset)
     
 
     def random_synset_with_specificity(self, lower, upper):
-        candidates = [hyp for hyp in self.specificities if 
-                      self.specificities[hyp] >=lower and
-                      self.specificities[hyp] <= upper]
+        if (lower, upper) not in self.candidates:
+            start = bisect_left(self.sorted_specificities, lower)
+            stop = bisect_right(self.sorted_specificities, upper)
+            self.candidates[(lower, upper)] = self.sorted_hyps[start:stop]
+        candidates = self.candidates[(lower, upper)]
         if len(candidates) > 0:
             return random.choice(candidates)
         else: